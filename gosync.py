@@ -2,16 +2,27 @@
 # -*- coding: utf-8 -*-
 
 import argparse
+import concurrent.futures
+import gzip
+import hashlib
 import logging
 import os
+import re
+import sys
 import threading
 import time
+import uuid
 from pathlib import Path
 from typing import Dict, List, Set
 
 import requests
-from flask import Flask, jsonify, request, send_file
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from flask import Flask, Response, jsonify, request, send_file
 from werkzeug.serving import make_server
+from werkzeug.wsgi import FileWrapper
+from watchdog.events import FileSystemEventHandler
+from watchdog.observers import Observer
 
 # 配置日志
 logging.basicConfig(
@@ -29,61 +40,393 @@ class GlobalState:
         self.port = 18283
         self.sync_delay = 10
         self.file_list = set()
-        self.file_list_lock = threading.RLock()
+        self.file_list_lock = threading.Lock()
+        # 文件列表变化时通知/subscribe的订阅者
+        self.file_list_changed = threading.Condition(self.file_list_lock)
+        # 缓存的/files响应: (版本号, 响应体, gzip压缩后的响应体或None)，整体替换以便无锁读取
+        self.file_list_cache = (-1, b"", None)
+        # 文件列表的只读快照: (版本号, frozenset)，版本号变化后才重新生成
+        self.file_list_snapshot = (-1, frozenset())
+        # 所有文件名64位哈希的异或值，与加入顺序无关，用于快速比较文件列表
+        self.file_list_xor = 0
+        # 按加入顺序记录的文件名，只追加不删除，其长度即文件列表版本号
+        self.file_list_log = []
+        # 本进程的文件列表标识，节点重启后版本号不再可比
+        self.file_list_id = uuid.uuid4().hex
+        # 正在从其他节点下载的文件，目录监听应忽略这些文件产生的事件
+        self.downloading = set()
+        # 各对等节点上次获取到的文件列表: ip -> (标识, 版本号, 文件集合)
+        self.peer_file_cache = {}
+        self.peer_file_cache_lock = threading.Lock()
+        # 通过/subscribe订阅到的各节点文件列表汇总哈希: ip -> 哈希
+        self.peer_hashes = {}
+        self.peer_hashes_lock = threading.Lock()
+        self.subscribe_heartbeat = 15
+        self.subscribe_retry_interval = 5
         self.ignored_nodes = set()
-        self.ignored_nodes_lock = threading.RLock()
+        self.ignored_nodes_lock = threading.Lock()
         self.sync_attempts = 0
         self.max_attempts = 5
+        self.max_retry_interval = 30
+        # 因同步有进展而提前开始、不计入尝试次数的轮数上限
+        self.max_early_rounds = 20
+        self.early_rounds = 0
+        self.server_ready = threading.Event()
+        # 收到其他节点推送的文件后置位，提前唤醒等待重试的同步循环
+        self.sync_event = threading.Event()
+        self.observer = None
+        # 新建或修改的文件在此时间内没有新事件才视为写入完成
+        self.watch_settle_delay = 1.0
+        # 本地新文件在此时间内合并为一次批量通知
+        self.announce_batch_delay = 0.5
+        self.session = None
+        self.executor = None
+        self.transfer_executor = None
+        self.inbound_executor = None
+        self.transfer_workers = 8
+        self.chunk_size = 1 << 16
+        self.gzip_min_size = 1024
+        self.send_buffer_size = 1 << 20
 
 # 初始化全局状态
 state = GlobalState()
 
+# 以更大的块读取待发送文件，减少/file响应的读写次数
+class LargeBufferFileWrapper(FileWrapper):
+    def __init__(self, file, buffer_size: int = 8192):
+        super().__init__(file, max(buffer_size, state.send_buffer_size))
+
 # 初始化Flask应用
 app = Flask(__name__)
 server = None
 
+# 计算文件名的64位哈希，各节点之间结果一致
+def file_name_hash(filename: str) -> int:
+    return int.from_bytes(hashlib.blake2b(filename.encode('utf-8'), digest_size=8).digest(), 'big')
+
+# 计算文件集合的汇总哈希
+def file_set_hash(files) -> int:
+    result = 0
+    for filename in files:
+        result ^= file_name_hash(filename)
+    return result
+
 # 线程安全的添加文件到文件列表
 def add_file_to_list(filename):
+    # 驻留文件名，使本地列表与各节点缓存的列表共用同一个字符串对象
+    filename = sys.intern(filename)
     with state.file_list_lock:
-        state.file_list.add(filename)
+        if filename not in state.file_list:
+            state.file_list.add(filename)
+            state.file_list_log.append(filename)
+            state.file_list_xor ^= file_name_hash(filename)
+            state.file_list_changed.notify_all()
 
-# 获取目录下所有文件的相对路径
-def scan_directory(directory: str) -> Set[str]:
-    files = set()
-    directory_path = Path(directory)
+# 无锁检查文件是否在文件列表中
+def has_file(filename: str) -> bool:
+    # 集合只会新增元素，单次成员检查在CPython中是原子的，
+    # 因此这里无需加锁；最坏情况只是错过一个刚刚加入的文件
+    return filename in state.file_list
+
+# 获取文件列表的只读快照，版本未变化时直接复用，调用方无需加锁
+def get_file_list_snapshot() -> frozenset:
+    snapshot = state.file_list_snapshot
+    if snapshot[0] == len(state.file_list_log):
+        return snapshot[1]
     
-    for file_path in directory_path.glob('**/*'):
-        if file_path.is_file():
-            rel_path = str(file_path.relative_to(directory_path))
-            # 统一使用正斜杠，确保跨平台一致性
-            rel_path = rel_path.replace('\\', '/')
-            files.add(rel_path)
+    with state.file_list_lock:
+        snapshot = (len(state.file_list_log), frozenset(state.file_list))
+        if snapshot[0] > state.file_list_snapshot[0]:
+            state.file_list_snapshot = snapshot
+    return snapshot[1]
+
+# 获取缓存的文件列表响应，仅在文件列表版本变化后重新生成
+def get_file_list_payload():
+    cache = state.file_list_cache
+    if cache[0] == len(state.file_list_log):
+        return cache
     
-    return files
+    # 只在锁内复制文件名，拼接在锁外进行；压缩推迟到第一次需要gzip的请求
+    with state.file_list_lock:
+        version = len(state.file_list_log)
+        snapshot = list(state.file_list_log)
+    payload = '\n'.join(snapshot).encode('utf-8')
+    cache = (version, payload, None)
+    
+    with state.file_list_lock:
+        if cache[0] > state.file_list_cache[0]:
+            state.file_list_cache = cache
+    return cache
+
+# 获取缓存响应的gzip压缩结果，同一版本只压缩一次
+def get_file_list_gzip(cache) -> bytes:
+    if cache[2] is not None:
+        return cache[2]
+    
+    compressed = gzip.compress(cache[1], compresslevel=6)
+    with state.file_list_lock:
+        current = state.file_list_cache
+        if current[0] == cache[0] and current[2] is None:
+            state.file_list_cache = (current[0], current[1], compressed)
+    return compressed
+
+# 根据请求头决定是否以gzip编码返回文本响应，compress为可选的获取压缩结果的函数
+def text_response(payload: bytes, compress=None) -> Response:
+    # 按q值判断客户端是否接受gzip，gzip;q=0表示不接受
+    accepts_gzip = request.accept_encodings['gzip'] > 0
+    if accepts_gzip and len(payload) >= state.gzip_min_size:
+        compressed = compress() if compress else gzip.compress(payload, compresslevel=6)
+        response = Response(compressed, mimetype='text/plain')
+        response.headers['Content-Encoding'] = 'gzip'
+    else:
+        response = Response(payload, mimetype='text/plain')
+    response.headers['Vary'] = 'Accept-Encoding'
+    return response
+
+# 获取指定版本之后新增的文件，版本无效时返回None
+def get_file_list_delta(since: int):
+    with state.file_list_lock:
+        if 0 <= since <= len(state.file_list_log):
+            return len(state.file_list_log), state.file_list_log[since:]
+    return None
+
+# 创建复用连接的HTTP会话
+def create_session() -> requests.Session:
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=max(1, len(state.peer_ips)),
+        pool_maxsize=32,
+        max_retries=Retry(total=2, backoff_factor=0.2)
+    )
+    session.mount('http://', adapter)
+    return session
+
+# 下载过程中使用的临时文件名: .<文件名>.<32位十六进制>.part
+PARTIAL_DOWNLOAD_PATTERN = re.compile(r'^\..+\.[0-9a-f]{32}\.part$')
+
+# 判断是否为下载中的临时文件
+def is_partial_download(name: str) -> bool:
+    return PARTIAL_DOWNLOAD_PATTERN.match(name.rsplit('/', 1)[-1]) is not None
+
+# 递归遍历目录，生成以正斜杠分隔的相对路径
+def _walk(root: str, prefix: str = ""):
+    # 与Path.glob一致，跳过没有读取权限的目录
+    try:
+        entries = os.scandir(root)
+    except PermissionError:
+        return
+    
+    with entries:
+        for entry in entries:
+            # DirEntry会复用读取目录时得到的类型信息，只有符号链接才需要额外stat
+            if entry.is_dir(follow_symlinks=False):
+                yield from _walk(entry.path, prefix + entry.name + "/")
+            elif entry.is_file() and not is_partial_download(entry.name):
+                yield prefix + entry.name
+
+# 获取目录下所有文件的相对路径
+def scan_directory(directory: str) -> Set[str]:
+    return set(map(sys.intern, _walk(directory)))
+
+# 登记即将下载的文件，文件已存在或正在下载时返回False
+def reserve_download(filename: str) -> bool:
+    with state.file_list_lock:
+        if filename in state.file_list or filename in state.downloading:
+            return False
+        state.downloading.add(filename)
+        return True
 
 # 下载文件
 def download_file(peer_url: str, filename: str) -> bool:
+    # 文件可能已在本轮同步中从其他节点下载完成，或正在下载
+    if not reserve_download(filename):
+        logger.info(f"文件 {filename} 已存在或正在下载，跳过从节点 {peer_url} 下载")
+        return True
+    return download_reserved_file(peer_url, filename)
+
+# 下载已通过reserve_download登记的文件，结束后解除登记
+def download_reserved_file(peer_url: str, filename: str) -> bool:
     try:
-        # 添加超时处理
-        response = requests.get(f"{peer_url}/file", params={"name": filename}, timeout=60)
-        if response.status_code != 200:
-            logger.error(f"从节点 {peer_url} 下载文件 {filename} 失败: 状态码 {response.status_code}")
-            return False
-        
-        # 创建目标路径
         file_path = Path(state.target_dir) / filename
-        file_path.parent.mkdir(parents=True, exist_ok=True)
         
-        # 写入文件内容
-        with open(file_path, 'wb') as f:
-            f.write(response.content)
+        # 本地已有同名文件时先比较大小，一致则直接使用本地文件
+        if file_path.is_file():
+            response = state.session.head(f"{peer_url}/file", params={"name": filename}, timeout=5)
+            if response.status_code == 200 and response.headers.get('Content-Length') == str(file_path.stat().st_size):
+                logger.info(f"本地文件 {filename} 与节点 {peer_url} 上的大小一致，跳过下载")
+                add_file_to_list(filename)
+                return True
+        
+        # 添加超时处理，以流式方式读取响应体
+        with state.session.get(f"{peer_url}/file", params={"name": filename}, timeout=60, stream=True) as response:
+            if response.status_code != 200:
+                logger.error(f"从节点 {peer_url} 下载文件 {filename} 失败: 状态码 {response.status_code}")
+                return False
+            
+            # 创建目标路径
+            file_path.parent.mkdir(parents=True, exist_ok=True)
+            
+            # 分块写入临时文件，完成后再替换，避免留下不完整的文件
+            tmp_path = file_path.with_name(f".{file_path.name}.{uuid.uuid4().hex}.part")
+            try:
+                with open(tmp_path, 'xb') as f:
+                    for chunk in response.iter_content(chunk_size=state.chunk_size):
+                        f.write(chunk)
+                os.replace(tmp_path, file_path)
+                add_file_to_list(filename)
+            except BaseException:
+                tmp_path.unlink(missing_ok=True)
+                raise
         
         logger.info(f"从节点 {peer_url} 成功下载文件 {filename}")
-        add_file_to_list(filename)
         return True
     except Exception as e:
         logger.error(f"从节点 {peer_url} 下载文件 {filename} 失败: {str(e)}")
         return False
+    finally:
+        with state.file_list_lock:
+            state.downloading.discard(filename)
+
+# 通知对等节点下载文件
+def notify_peer(peer_url: str, filename: str):
+    try:
+        state.session.get(f"{peer_url}/sync", params={"file": filename}, timeout=30)
+    except Exception as e:
+        logger.error(f"通知节点 {peer_url} 下载文件 {filename} 失败: {str(e)}")
+
+# 一次性通知对等节点下载多个文件，节点不支持批量接口时逐个通知
+def notify_peer_batch(peer_url: str, filenames):
+    if not filenames:
+        return
+    
+    try:
+        response = state.session.post(f"{peer_url}/sync_batch", json=list(filenames), timeout=30)
+        if response.status_code not in (404, 405):
+            if response.status_code != 200:
+                logger.error(f"通知节点 {peer_url} 批量下载文件失败: 状态码 {response.status_code}")
+            return
+    except Exception as e:
+        logger.error(f"通知节点 {peer_url} 批量下载文件失败: {str(e)}")
+        return
+    
+    list(state.transfer_executor.map(lambda f: notify_peer(peer_url, f), filenames))
+
+# 将本地新出现的文件加入文件列表，返回是否为新文件
+def add_local_file(filename: str) -> bool:
+    with state.file_list_lock:
+        if filename in state.file_list or filename in state.downloading:
+            return False
+    
+    add_file_to_list(filename)
+    logger.info(f"检测到本地新文件 {filename}")
+    return True
+
+# 以批量请求通知各节点下载本地新文件
+def notify_local_files(filenames):
+    # 本节点服务器启动前其他节点无法下载，新文件留给第一轮同步推送
+    if not state.server_ready.is_set():
+        return
+    
+    logger.info(f"通知其他节点下载 {len(filenames)} 个本地新文件")
+    for ip in state.peer_ips:
+        if not should_ignore_node(ip):
+            state.executor.submit(notify_peer_batch, f"http://{ip}:{state.port}", filenames)
+
+# 监听同步目录，把本地新增的文件增量加入文件列表
+# 支持关闭事件的后端(Linux inotify)只在文件写入后关闭或被移动到位时公布文件；
+# 其他后端没有关闭事件，只能在文件一段时间没有新事件后公布，
+# 写入过程中停顿超过watch_settle_delay的文件可能被提前公布
+class LocalChangeHandler(FileSystemEventHandler):
+    def __init__(self, directory: str, close_events: bool):
+        super().__init__()
+        self.directory = directory
+        self.close_events = close_events
+        # 等待写入完成的文件: 路径 -> 截止时间，只在没有关闭事件时使用
+        self.settle_deadlines = {}
+        # 短时间内公布的文件合并成一次批量通知
+        self.batch = []
+        self.batch_deadline = None
+        self.condition = threading.Condition()
+        threading.Thread(target=self._run, daemon=True).start()
+    
+    def _relative_path(self, path) -> str:
+        if isinstance(path, bytes):
+            path = os.fsdecode(path)
+        return os.path.relpath(path, self.directory).replace(os.sep, '/')
+    
+    # 文件写入完成后再公布，避免其他节点下载到不完整的内容
+    def _announce(self, path):
+        with self.condition:
+            self.settle_deadlines.pop(path, None)
+        
+        filename = self._relative_path(path)
+        if not is_partial_download(filename) and os.path.isfile(path):
+            self._queue(filename)
+    
+    # 加入待通知的批次，批次在第一个文件加入后announce_batch_delay秒发出
+    def _queue(self, filename: str):
+        if not add_local_file(filename):
+            return
+        with self.condition:
+            self.batch.append(filename)
+            if self.batch_deadline is None:
+                self.batch_deadline = time.monotonic() + state.announce_batch_delay
+                self.condition.notify()
+    
+    # 由单个后台线程公布到期的文件并发出批量通知，避免每个事件创建一个线程
+    def _run(self):
+        while True:
+            filenames = None
+            with self.condition:
+                now = time.monotonic()
+                settled = [path for path, deadline in self.settle_deadlines.items() if deadline <= now]
+                if self.batch_deadline is not None and self.batch_deadline <= now:
+                    filenames, self.batch, self.batch_deadline = self.batch, [], None
+                
+                if not settled and not filenames:
+                    deadlines = list(self.settle_deadlines.values())
+                    if self.batch_deadline is not None:
+                        deadlines.append(self.batch_deadline)
+                    self.condition.wait(min(deadlines) - now if deadlines else None)
+                    continue
+            
+            for path in settled:
+                self._announce(path)
+            if filenames:
+                notify_local_files(filenames)
+    
+    # 新建或修改的文件等待一段时间没有新事件后再公布
+    def _settle(self, path):
+        with self.condition:
+            self.settle_deadlines[path] = time.monotonic() + state.watch_settle_delay
+            self.condition.notify()
+    
+    def on_created(self, event):
+        if not event.is_directory and not self.close_events:
+            self._settle(event.src_path)
+    
+    def on_modified(self, event):
+        if not event.is_directory and not self.close_events:
+            with self.condition:
+                waiting = event.src_path in self.settle_deadlines
+            if waiting:
+                self._settle(event.src_path)
+    
+    def on_closed(self, event):
+        if not event.is_directory:
+            self._announce(event.src_path)
+    
+    def on_moved(self, event):
+        # 从监听目录外移入时源路径为空，移出时目标路径为空
+        if not event.dest_path:
+            return
+        if not event.is_directory:
+            self._announce(event.dest_path)
+        elif os.path.isdir(event.dest_path):
+            # 移入的目录不会为其中的文件单独产生事件
+            prefix = self._relative_path(event.dest_path) + '/'
+            for filename in _walk(event.dest_path, prefix):
+                self._queue(filename)
 
 # 检查节点是否应被忽略
 def should_ignore_node(ip: str) -> bool:
@@ -96,25 +439,103 @@ def ignore_node(ip: str):
         state.ignored_nodes.add(ip)
         logger.info(f"忽略无法连接的节点: {ip}")
 
+# 获取对等节点的文件列表，若之前获取过则只请求增量
+def fetch_peer_files(ip: str, timeout: int):
+    peer_url = f"http://{ip}:{state.port}"
+    with state.peer_file_cache_lock:
+        cached = state.peer_file_cache.get(ip)
+    
+    params = {}
+    if cached:
+        params = {"id": cached[0], "since": cached[1]}
+    
+    response = state.session.get(f"{peer_url}/files", params=params, timeout=timeout)
+    if response.status_code != 200:
+        logger.error(f"无法获取节点 {peer_url} 的文件列表: 状态码 {response.status_code}")
+        return None
+    
+    # 解析对等节点文件列表；旧版本节点不支持增量，总是返回完整列表
+    # 文件名固定按UTF-8解码并只以换行分隔，不依赖响应头中的字符集
+    files = set(map(sys.intern, filter(None, response.content.decode('utf-8').split('\n'))))
+    if cached and response.headers.get("X-File-List-Delta") == "1":
+        files |= cached[2]
+    
+    list_id = response.headers.get("X-File-List-Id")
+    version = response.headers.get("X-File-List-Version")
+    with state.peer_file_cache_lock:
+        if list_id and version:
+            state.peer_file_cache[ip] = (list_id, int(version), files)
+        else:
+            state.peer_file_cache.pop(ip, None)
+    return files
+
+# 获取对等节点文件列表的汇总哈希，节点不支持时返回None
+def fetch_peer_hash(ip: str, timeout: int):
+    response = state.session.get(f"http://{ip}:{state.port}/files_hash", timeout=timeout)
+    if response.status_code != 200:
+        return None
+    return int(response.text, 16)
+
+# 获取对等节点的汇总哈希，订阅有效时直接使用推送的值
+def get_peer_hash(ip: str, timeout: int):
+    with state.peer_hashes_lock:
+        peer_hash = state.peer_hashes.get(ip)
+    if peer_hash is not None:
+        return peer_hash
+    return fetch_peer_hash(ip, timeout)
+
+# 订阅对等节点的文件列表变化，连接断开期间回退为轮询
+def subscribe_peer(ip: str):
+    peer_url = f"http://{ip}:{state.port}"
+    # 上次收到的哈希跨重连保留，重连后推送相同的值不算变化
+    last_hash = None
+    while not should_ignore_node(ip):
+        try:
+            with state.session.get(f"{peer_url}/subscribe", stream=True,
+                                   timeout=(5, state.subscribe_heartbeat * 3)) as response:
+                # 旧版本节点不支持订阅，一直使用轮询
+                if response.status_code != 200:
+                    return
+                
+                for line in response.iter_lines(decode_unicode=True):
+                    if not line.startswith('data:'):
+                        continue
+                    peer_hash = int(line[len('data:'):].strip(), 16)
+                    with state.peer_hashes_lock:
+                        state.peer_hashes[ip] = peer_hash
+                    # 已知的哈希发生变化说明节点文件列表有更新，唤醒主循环重新检查
+                    if last_hash is not None and peer_hash != last_hash:
+                        state.sync_event.set()
+                    last_hash = peer_hash
+        except Exception as e:
+            logger.debug(f"订阅节点 {peer_url} 的文件列表变化中断: {str(e)}")
+        finally:
+            with state.peer_hashes_lock:
+                state.peer_hashes.pop(ip, None)
+        
+        time.sleep(state.subscribe_retry_interval)
+
 # 与对等节点同步
 def sync_with_peer(ip: str):
     peer_url = f"http://{ip}:{state.port}"
     logger.info(f"与节点 {peer_url} 开始同步")
     
     try:
-        # 获取对等节点的文件列表
-        response = requests.get(f"{peer_url}/files", timeout=30)
-        if response.status_code != 200:
-            logger.error(f"无法获取节点 {peer_url} 的文件列表: 状态码 {response.status_code}")
+        # 汇总哈希一致时文件列表相同，无需获取列表和计算差集
+        with state.file_list_lock:
+            local_hash = state.file_list_xor
+        if get_peer_hash(ip, timeout=30) == local_hash:
+            logger.info(f"节点 {peer_url} 的文件列表与本地一致，跳过同步")
             return
         
-        # 解析对等节点文件列表
-        peer_files = set(response.text.splitlines())
+        # 获取对等节点的文件列表
+        peer_files = fetch_peer_files(ip, timeout=30)
+        if peer_files is None:
+            return
         logger.info(f"节点 {peer_url} 的文件列表: {peer_files}")
         
         # 获取本地文件列表
-        with state.file_list_lock:
-            local_files = state.file_list.copy()
+        local_files = get_file_list_snapshot()
         
         # 找出需要推送和拉取的文件
         files_to_push = local_files - peer_files
@@ -123,26 +544,33 @@ def sync_with_peer(ip: str):
         logger.info(f"将向节点 {peer_url} 推送的文件: {files_to_push}")
         logger.info(f"将从节点 {peer_url} 拉取的文件: {files_to_pull}")
         
-        # 下载对方有我没有的文件
-        for file in files_to_pull:
-            download_file(peer_url, file)
+        # 并发下载对方有我没有的文件
+        list(state.transfer_executor.map(lambda f: download_file(peer_url, f), files_to_pull))
         
         # 通知对方下载我有它没有的文件
-        for file in files_to_push:
-            try:
-                requests.get(f"{peer_url}/sync", params={"file": file}, timeout=30)
-            except Exception as e:
-                logger.error(f"通知节点 {peer_url} 下载文件 {file} 失败: {str(e)}")
+        notify_peer_batch(peer_url, files_to_push)
         
         logger.info(f"与节点 {peer_url} 同步完成")
     except Exception as e:
         logger.error(f"与节点 {peer_url} 同步失败: {str(e)}")
 
+# 并发地与所有对等节点进行一轮同步
+def sync_round():
+    futures = [state.executor.submit(sync_with_peer, ip) for ip in state.peer_ips]
+    
+    # 等待所有同步任务完成
+    concurrent.futures.wait(futures)
+
 # 检查所有节点是否同步完成
 def check_all_nodes_in_sync() -> bool:
     accessible_node_count = 0
     total_node_count = len(state.peer_ips)
     
+    # 每次检查只读取一次本地状态
+    with state.file_list_lock:
+        local_hash = state.file_list_xor
+    local_files = get_file_list_snapshot()
+    
     for ip in state.peer_ips:
         # 跳过已标记为忽略的节点
         if should_ignore_node(ip):
@@ -151,18 +579,17 @@ def check_all_nodes_in_sync() -> bool:
         peer_url = f"http://{ip}:{state.port}"
         
         try:
-            # 获取对等节点的文件列表
-            response = requests.get(f"{peer_url}/files", timeout=5)
-            if response.status_code != 200:
-                logger.error(f"无法获取节点 {peer_url} 的文件列表: 状态码 {response.status_code}")
-                continue
-            
-            # 解析对等节点文件列表
-            peer_files = set(response.text.splitlines())
-            
-            # 比较文件列表
-            with state.file_list_lock:
-                files_match = peer_files == state.file_list
+            # 先比较文件列表的汇总哈希(订阅有效时无需请求)，节点不支持时再获取完整文件列表比较
+            peer_hash = get_peer_hash(ip, timeout=5)
+            if peer_hash is not None:
+                files_match = peer_hash == local_hash
+            else:
+                peer_files = fetch_peer_files(ip, timeout=5)
+                if peer_files is None:
+                    continue
+                
+                # 比较文件列表
+                files_match = peer_files == local_files
             
             if files_match:
                 accessible_node_count += 1
@@ -179,12 +606,67 @@ def check_all_nodes_in_sync() -> bool:
     # 如果所有未忽略的节点都同步完成，则认为同步成功
     return accessible_node_count + ignored_count >= total_node_count
 
+# 异步从远程节点下载文件，成功后唤醒等待重试的同步循环
+# 文件已存在或正在下载时不再安排，返回是否安排了下载
+def schedule_download(remote_url: str, filename: str) -> bool:
+    if not reserve_download(filename):
+        return False
+    
+    def download_async():
+        if download_reserved_file(remote_url, filename):
+            state.sync_event.set()
+    
+    state.inbound_executor.submit(download_async)
+    return True
+
 # Flask路由
 @app.route('/files', methods=['GET'])
 def handle_file_list():
-    """返回文件列表"""
-    with state.file_list_lock:
-        return '\n'.join(state.file_list)
+    """返回文件列表，请求方提供有效的版本号时只返回之后新增的文件"""
+    delta = None
+    if request.args.get('id') == state.file_list_id:
+        try:
+            delta = get_file_list_delta(int(request.args.get('since', '')))
+        except ValueError:
+            pass
+    
+    if delta is not None:
+        version, added = delta
+        response = text_response('\n'.join(added).encode('utf-8'))
+        response.headers['X-File-List-Delta'] = '1'
+    else:
+        cache = get_file_list_payload()
+        version, payload = cache[0], cache[1]
+        response = text_response(payload, lambda: get_file_list_gzip(cache))
+    
+    response.headers['X-File-List-Id'] = state.file_list_id
+    response.headers['X-File-List-Version'] = str(version)
+    return response
+
+@app.route('/files_hash', methods=['GET'])
+def handle_file_list_hash():
+    """返回文件列表的汇总哈希"""
+    return Response(f"{state.file_list_xor:016x}", mimetype='text/plain')
+
+@app.route('/subscribe', methods=['GET'])
+def handle_subscribe():
+    """以Server-Sent Events推送文件列表汇总哈希，哈希变化时发送新值"""
+    def stream():
+        last_hash = None
+        while True:
+            with state.file_list_changed:
+                state.file_list_changed.wait_for(lambda: state.file_list_xor != last_hash,
+                                                 timeout=state.subscribe_heartbeat)
+                current_hash = state.file_list_xor
+            
+            if current_hash != last_hash:
+                last_hash = current_hash
+                yield f"data: {current_hash:016x}\n\n"
+            else:
+                # 定期发送心跳，让双方及时发现断开的连接
+                yield ": keepalive\n\n"
+    
+    return Response(stream(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
 
 @app.route('/file', methods=['GET'])
 def handle_file_download():
@@ -197,7 +679,9 @@ def handle_file_download():
     if not os.path.exists(file_path):
         return "文件不存在", 404
     
-    return send_file(file_path, as_attachment=True)
+    # werkzeug服务器不提供sendfile，这里替换默认8KB块大小的文件包装器
+    request.environ.setdefault('wsgi.file_wrapper', LargeBufferFileWrapper)
+    return send_file(file_path, as_attachment=True, conditional=True)
 
 @app.route('/sync', methods=['GET'])
 def handle_sync_request():
@@ -207,31 +691,45 @@ def handle_sync_request():
         return "文件名不能为空", 400
     
     # 检查文件是否已存在
-    with state.file_list_lock:
-        exists = filename in state.file_list
-    
-    if exists:
+    if has_file(filename):
         return "文件已存在"
     
     # 获取远程节点地址
     remote_ip = request.remote_addr
     remote_url = f"http://{remote_ip}:{state.port}"
     
-    # 异步下载文件
-    def download_async():
-        if download_file(remote_url, filename):
-            with state.file_list_lock:
-                state.file_list.add(filename)
-    
-    threading.Thread(target=download_async).start()
+    if not schedule_download(remote_url, filename):
+        return "文件正在下载"
     return "开始下载文件"
 
+@app.route('/sync_batch', methods=['POST'])
+def handle_sync_batch_request():
+    """处理批量同步请求，请求体为文件名的JSON数组"""
+    filenames = request.get_json(silent=True)
+    if not isinstance(filenames, list) or not all(isinstance(f, str) and f for f in filenames):
+        return "请求体必须是文件名数组", 400
+    
+    # 获取远程节点地址
+    remote_ip = request.remote_addr
+    remote_url = f"http://{remote_ip}:{state.port}"
+    
+    count = 0
+    for filename in filenames:
+        if not has_file(filename) and schedule_download(remote_url, filename):
+            count += 1
+    return f"开始下载 {count} 个文件"
+
 @app.route('/check', methods=['GET'])
 def handle_check_sync():
     """处理检查同步状态请求"""
     # 这个端点可以用于将来的扩展
     return "PENDING"
 
+# 运行HTTP服务器，开始处理请求前通知主线程
+def serve_forever():
+    state.server_ready.set()
+    server.serve_forever()
+
 # 主函数
 def main():
     parser = argparse.ArgumentParser(description='GoSync Python版 - 多机文件同步工具')
@@ -250,44 +748,65 @@ def main():
     if args.peers:
         state.peer_ips = args.peers.split(',')
     
+    # 创建共享的HTTP会话，复用到各节点的连接
+    state.session = create_session()
+    
+    # 创建复用的工作线程池，用于节点同步和发送通知
+    state.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(10, 2 * len(state.peer_ips)))
+    # 文件传输使用独立的线程池，避免与节点同步任务互相等待
+    state.transfer_executor = concurrent.futures.ThreadPoolExecutor(max_workers=state.transfer_workers)
+    # 其他节点通知的下载使用单独的线程池，大批通知不会占满同步任务的线程
+    state.inbound_executor = concurrent.futures.ThreadPoolExecutor(max_workers=state.transfer_workers)
+    
     # 确保目标目录存在
     os.makedirs(state.target_dir, exist_ok=True)
     
-    # 扫描目录并建立文件列表
-    state.file_list = scan_directory(state.target_dir)
+    # 先开始监听目录，避免遗漏扫描期间新增的文件
+    # inotify后端提供关闭事件；生成完整的移动事件，使从目录外移入的文件也以移动事件报告
+    close_events = Observer.__name__ == 'InotifyObserver'
+    state.observer = Observer(generate_full_events=True) if close_events else Observer()
+    state.observer.schedule(LocalChangeHandler(state.target_dir, close_events), state.target_dir, recursive=True)
+    state.observer.start()
+    
+    # 扫描目录并合并到文件列表，保留监听器在扫描期间已加入的文件
+    scanned_files = scan_directory(state.target_dir)
+    with state.file_list_lock:
+        new_files = scanned_files - state.file_list
+        state.file_list |= new_files
+        state.file_list_log.extend(new_files)
+        state.file_list_xor ^= file_set_hash(new_files)
     logger.info(f"本地文件列表: {state.file_list}")
     
     # 启动HTTP服务器
     global server
     server = make_server('0.0.0.0', state.port, app, threaded=True)
-    server_thread = threading.Thread(target=server.serve_forever)
+    server_thread = threading.Thread(target=serve_forever)
     server_thread.daemon = True
     server_thread.start()
-    logger.info(f"服务器在端口 {state.port} 上启动")
     
-    # 给服务器一些启动时间
-    time.sleep(1)
+    # 等待服务器线程开始处理请求
+    state.server_ready.wait(timeout=5)
+    logger.info(f"服务器在端口 {state.port} 上启动")
     
     # 如果没有对等节点，程序可以直接退出
     if not state.peer_ips:
         logger.info("没有指定对等节点，退出程序")
         return
     
-    # 开始同步循环
-    while state.sync_attempts < state.max_attempts:
-        state.sync_attempts += 1
-        logger.info(f"开始第 {state.sync_attempts} 次同步尝试")
-        
-        # 创建线程池来与每个对等节点同步
-        threads = []
-        for ip in state.peer_ips:
-            thread = threading.Thread(target=sync_with_peer, args=(ip,))
-            thread.start()
-            threads.append(thread)
+    # 订阅各节点的文件列表变化，检查同步状态时无需轮询
+    for ip in state.peer_ips:
+        threading.Thread(target=subscribe_peer, args=(ip,), daemon=True).start()
+    
+    # 开始同步循环；因同步有进展而提前开始的一轮单独计数，不计入尝试次数
+    early_round = False
+    while early_round or state.sync_attempts < state.max_attempts:
+        if early_round:
+            logger.info(f"同步有新进展，开始第 {state.early_rounds} 次提前同步 (不计入尝试次数)")
+        else:
+            state.sync_attempts += 1
+            logger.info(f"开始第 {state.sync_attempts} 次同步尝试")
         
-        # 等待所有同步线程完成
-        for thread in threads:
-            thread.join()
+        sync_round()
         
         # 检查是否所有节点都同步完成
         if check_all_nodes_in_sync():
@@ -297,9 +816,16 @@ def main():
             logger.info("退出程序")
             return
         
-        # 等待一段时间后重新尝试
-        logger.info("同步未完成，等待后重试...")
-        time.sleep(3)
+        # 清除本轮同步和检查期间的通知，只让检查之后的进展提前唤醒下一轮
+        state.sync_event.clear()
+        
+        # 按指数退避等待后重新尝试，收到其他节点推送的文件时提前开始
+        retry_interval = min(state.max_retry_interval, 1.5 ** state.sync_attempts)
+        logger.info(f"同步未完成，最多等待 {retry_interval:.1f} 秒后重试...")
+        # 提前开始的轮数有上限，保证程序最终退出
+        early_round = state.sync_event.wait(timeout=retry_interval) and state.early_rounds < state.max_early_rounds
+        if early_round:
+            state.early_rounds += 1
     
     logger.info(f"达到最大尝试次数 {state.max_attempts}，退出程序")
 
@@ -309,4 +835,15 @@ if __name__ == "__main__":
     finally:
         # 确保服务器正确关闭
         if server:
-            server.shutdown() 
\ No newline at end of file
+            server.shutdown()
+        if state.observer:
+            state.observer.stop()
+            state.observer.join()
+        if state.executor:
+            state.executor.shutdown()
+        if state.transfer_executor:
+            state.transfer_executor.shutdown()
+        if state.inbound_executor:
+            state.inbound_executor.shutdown()
+        if state.session:
+            state.session.close() 
\ No newline at end of file